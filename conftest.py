@@ -0,0 +1,22 @@
+import os
+# Must be set before tensorflow is imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+
+
+def pytest_configure(config):
+    # The xdist controller runs no tests, so only workers and serial runs need the frameworks
+    if getattr(config.option, "numprocesses", None) and not hasattr(config, "workerinput"):
+        return
+    import tensorflow as tf
+    import torch
+    # Split the cores between pytest-xdist workers so their thread pools do not oversubscribe
+    workers = int(os.environ.get("PYTEST_XDIST_WORKER_COUNT", 1))
+    threads = max(1, os.cpu_count() // workers)
+    if workers > 1:
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    torch.set_num_threads(threads)
+    # The test models are tiny, so graph optimization and XLA cost more than they save
+    tf.config.optimizer.set_jit(False)
+    tf.config.optimizer.set_experimental_options({"disable_meta_optimizer": True})
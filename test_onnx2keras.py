@@ -1,58 +1,342 @@
+import gc
+import json
+import os
 import warnings
 from io import BytesIO
-from tempfile import NamedTemporaryFile
+from tempfile import gettempdir
+from uuid import uuid4
 
 import onnx
+from onnx import numpy_helper
 import torch.nn
 from torch.nn import Module
 import torch.nn.functional as F
 from torchvision import models
-from numpy.testing import assert_almost_equal
 import numpy as np
+import pytest
 import tensorflow as tf
 
 from onnx2keras import onnx2keras, compatible_data_format, OnnxConstant, OnnxTensor, InterleavedImageBatch, \
     ensure_data_format, OptimizationMissingWarning
 
+_SAVE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else gettempdir()
+_ONNX_CACHE = {}
+_SAVED_SIGS = set()
+_NHWC_CACHE = {}
 
-def make_onnx_model(net, indata, opset_version=None):
+
+def _rand32(*shape):
+    # A fresh generator per call, so an input never depends on which tests ran before it
+    return np.random.default_rng(0).random(shape, dtype=np.float32)
+
+
+def _shared_input(*shape):
+    x = _rand32(*shape)
+    x.setflags(write=False)
+    return x
+
+
+@pytest.fixture(scope="session")
+def x_1_3_224_224():
+    return _shared_input(1, 3, 224, 224)
+
+
+@pytest.fixture(scope="session")
+def x_1_3_112_112():
+    return _shared_input(1, 3, 112, 112)
+
+
+@pytest.fixture(scope="session")
+def x_1_3_16_16():
+    return _shared_input(1, 3, 16, 16)
+
+
+@pytest.fixture(scope="session")
+def x_4_3_16_16():
+    return _shared_input(4, 3, 16, 16)
+
+
+@pytest.fixture(scope="session")
+def x_4_3_16_32():
+    return _shared_input(4, 3, 16, 32)
+
+
+def _onnx_cache_key(net, indata, opset_version):
+    # Module classes are kept alive by the key itself, so locally defined classes never alias
+    modules = tuple((type(m), m.training) for m in net.modules())
+    params = tuple((name, tuple(p.shape)) for name, p in net.state_dict().items())
+    return modules, repr(net), tuple(indata.shape), opset_version, params
+
+
+def _parse_onnx(buf):
+    model = onnx.ModelProto()
+    model.ParseFromString(buf)
+    return model
+
+
+def _swap_initializers(model, net):
+    state = net.state_dict()
+    for init in model.graph.initializer:
+        if init.name not in state:
+            return None
+        value = state[init.name].detach().cpu().numpy()
+        if tuple(init.dims) != value.shape:
+            return None
+        init.CopyFrom(numpy_helper.from_array(value, init.name))
+    return model
+
+
+def make_onnx_model(net, indata, opset_version=11):
+    key = _onnx_cache_key(net, indata, opset_version)
+    cached = _ONNX_CACHE.get(key)
+    if cached is not None:
+        model = _swap_initializers(_parse_onnx(cached), net)
+        if model is not None:
+            return model
     fd = BytesIO()
-    torch.onnx.export(net, indata, fd, opset_version=opset_version)
-    fd.seek(0)
-    return onnx.load(fd)
+    # The legacy exporter is kept; dynamo_export emits opset 18 graphs the converter can not handle
+    with torch.no_grad():
+        torch.onnx.export(net, indata, fd, opset_version=opset_version)
+    buf = fd.getvalue()
+    _ONNX_CACHE[key] = buf
+    return _parse_onnx(buf)
+
+
+def _layer_signature(layer):
+    config = {k: v for k, v in layer.get_config().items() if k != 'name'}
+    return type(layer).__name__, json.dumps(config, sort_keys=True, default=repr)
+
+
+def _save_signature(kernas_net):
+    return (tuple(_layer_signature(l) for l in kernas_net.layers) +
+            tuple(tuple(w.shape.as_list()) for w in kernas_net.weights))
+
+
+def _call_keras(model, x):
+    if not tf.executing_eagerly():
+        return model.predict(x)
+    # Every model is called once, so tracing it into a tf.function would never pay off
+    y = model(tf.constant(x), training=False)
+    if isinstance(y, (list, tuple)):
+        return [t.numpy() for t in y]
+    return y.numpy()
+
 
+def _to_nhwc(indata):
+    # Only read-only inputs (the shared fixtures) are cached, as they can not change under the cache
+    if indata.flags.writeable:
+        return np.ascontiguousarray(indata.transpose(0, 2, 3, 1))
+    cached = _NHWC_CACHE.get(id(indata))
+    if cached is None or cached[0] is not indata:
+        cached = (indata, np.ascontiguousarray(indata.transpose(0, 2, 3, 1)))
+        _NHWC_CACHE[id(indata)] = cached
+    return cached[1]
 
-def convert_and_compare_output(net, indata, precition=5, image_out=True, savable=True, missing_optimizations=False, opset_version=None):
-    try:
-        return _convert_and_compare_output(net, indata, precition, image_out, savable, missing_optimizations, opset_version)
-    except AssertionError:
-        return _convert_and_compare_output(net, indata, precition, image_out, savable, missing_optimizations, opset_version)
 
-def _convert_and_compare_output(net, indata, precition=5, image_out=True, savable=True, missing_optimizations=False, opset_version=None):
+def _check_close(y1, y2, precition):
+    # Same threshold as assert_almost_equal, but the message is only built on failure
+    tol = 1.5 * 10.0 ** -precition
+    assert y1.shape == y2.shape, "shape mismatch: %s != %s" % (y1.shape, y2.shape)
+    if not np.allclose(y1, y2, atol=tol, rtol=0):
+        raise AssertionError("mismatch: max|dy|=%g tol=%g" % (np.max(np.abs(y1 - y2)), tol))
+
+
+def seed_everything(seed=0):
+    torch.manual_seed(seed)
+    tf.compat.v1.set_random_seed(seed)
+
+
+def convert_and_compare_output(net, indata, precition=5, image_out=True, savable=True, missing_optimizations=False, opset_version=11):
+    return convert_and_compare_outputs([net], indata, precition, image_out, savable, missing_optimizations,
+                                       opset_version)[0]
+
+
+def convert_and_compare_outputs(nets, indata, precition=5, image_out=True, savable=True, missing_optimizations=False, opset_version=11):
     torch_indata = torch.tensor(indata)
-    y1 = net(torch_indata).detach().numpy()
-    onnx_model = make_onnx_model(net, torch.zeros_like(torch_indata), opset_version)
-    with warnings.catch_warnings(record=True) as warns:
-        warnings.simplefilter("always")
-        kernas_net = onnx2keras(onnx_model)
-        warns = [w for w in warns if w.category is OptimizationMissingWarning]
-        if not missing_optimizations:
-            assert len(warns) == 0
-    if savable:
-        with NamedTemporaryFile() as f:
-            f.close()
-            kernas_net.save(f.name)
-    y2 = kernas_net.predict(indata.transpose(0, 2, 3, 1))
-    if image_out:
-        y2 = y2.transpose(0, 3, 1, 2)
-    assert_almost_equal(y1, y2, precition)
-    return kernas_net
+    expected = []
+    kernas_nets = []
+    for net in nets:
+        expected.append(net(torch_indata).detach().numpy())
+        onnx_model = make_onnx_model(net, torch_indata, opset_version)
+        with warnings.catch_warnings(record=True) as warns:
+            warnings.simplefilter("always")
+            kernas_net = onnx2keras(onnx_model)
+            warns = [w for w in warns if w.category is OptimizationMissingWarning]
+            if not missing_optimizations:
+                assert len(warns) == 0
+        if savable:
+            sig = _save_signature(kernas_net)
+            if sig not in _SAVED_SIGS:
+                path = os.path.join(_SAVE_DIR, "m%s.h5" % uuid4().hex)
+                try:
+                    kernas_net.save(path, save_format='h5')
+                finally:
+                    if os.path.exists(path):
+                        os.unlink(path)
+                _SAVED_SIGS.add(sig)
+        kernas_nets.append(kernas_net)
+    # All nets share the same input, so run them as a single multi-output model
+    if len(kernas_nets) == 1:
+        combined = kernas_nets[0]
+    else:
+        inp = tf.keras.layers.Input(batch_shape=kernas_nets[0].input_shape)
+        combined = tf.keras.models.Model(inp, [k(inp) for k in kernas_nets])
+    outputs = _call_keras(combined, _to_nhwc(indata))
+    if len(kernas_nets) == 1:
+        outputs = [outputs]
+    for y1, y2 in zip(expected, outputs):
+        if image_out:
+            y2 = y2.transpose(0, 3, 1, 2)
+        _check_close(y1, y2, precition)
+    return kernas_nets
 
 class GlobalAvgPool(Module):
     def forward(self, x):
         return x.mean([2, 3])
 
 
+class _DblCat(Module):
+    def __init__(self, axis):
+        Module.__init__(self)
+        self.axis = axis
+
+    def extra_repr(self):
+        return 'axis=%d' % self.axis
+
+    def forward(self, x):
+        return torch.cat((x, x), self.axis)
+
+
+class _Clamp03_07(Module):
+    def forward(self, x):
+        return torch.clamp(x, 0.3, 0.7)
+
+
+class _Clamp0_6(Module):
+    def forward(self, x):
+        return torch.clamp(x, 0, 6)
+
+
+class _AddTst(Module):
+    def __init__(self):
+        Module.__init__(self)
+        self.conv1 = torch.nn.Conv2d(3, 3, 7)
+        self.conv2 = torch.nn.Conv2d(3, 3, 7)
+    def forward(self, x):
+        return self.conv1(x).relu_() + self.conv2(x).relu_()
+
+
+class _AvgPoolPad(Module):
+    def forward(self, x):
+        return F.avg_pool2d(x, kernel_size=3, stride=1, padding=1)
+
+
+class _AvgPoolPadAsym(Module):
+    def forward(self, x):
+        return F.avg_pool2d(x, kernel_size=(3, 6), stride=(1, 2), padding=(1, 2))
+
+
+class _AdaptiveAvgPool1x1(Module):
+    def forward(self, x):
+        return F.adaptive_avg_pool2d(x, (1, 1))
+
+
+class _Flatten(Module):
+    def forward(self, x):
+        return torch.flatten(x, 1)
+
+
+class _VectorPad2D(Module):
+    def forward(self, x):
+        tt = [torch.nn.functional.pad(x[:, i:i + 1], [1,1,1,1], 'constant', [1,2,3][i])
+              for i in range(x.shape[1])]
+        return torch.cat(tt, 1)
+
+
+class _VectorPad2DAddHack(Module):
+    def forward(self, x):
+        c = torch.tensor([1,2,3]).reshape(1, 3, 1, 1)
+        return torch.nn.functional.pad(x - c, [1,1,1,1]) + c
+
+
+class _VectorPad2DAddHackAsym(Module):
+    def forward(self, x):
+        c = torch.tensor([1,2,3]).reshape(1, 3, 1, 1)
+        return torch.nn.functional.pad(x - c, [1,0,1,0]) + c
+
+
+class _InterpolateNearest(Module):
+    def forward(self, x):
+        return F.interpolate(x, scale_factor=2, mode="nearest")
+
+
+class _InterpolateBilinear(Module):
+    def forward(self, x):
+        return F.interpolate(x, scale_factor=2, mode="bilinear", align_corners=True)
+
+
+class _EqProd(Module):
+    def forward(self, x):
+        maxmap = F.max_pool2d(x, 3, 1, 1, 1, False, False)
+        return x * (maxmap == x)
+
+
+class _AdaptiveAvgPoolReshape(Module):
+    def forward(self, x):
+        return F.adaptive_avg_pool2d(x, 1).reshape(x.shape[0], -1)
+
+
+class _Bmm(Module):
+    def forward(self, x):
+        x = x.reshape(1, 16, 16)
+        return torch.bmm(x, x)
+
+
+class _Matmul(Module):
+    def forward(self, x):
+        x = x.reshape(1, 1, 16, 16)
+        return torch.matmul(x, x)
+
+
+class _Reshape4x4x16x16(Module):
+    def forward(self, x):
+        return x.reshape(4, 4, 16, 16)
+
+
+class _Sqrt(Module):
+    def forward(self, x):
+        return torch.sqrt(x)
+
+
+class _Abs(Module):
+    def forward(self, x):
+        return torch.abs(x)
+
+
+class _Neg(Module):
+    def forward(self, x):
+        return -x
+
+
+class _CenterCrop8x8(Module):
+    def forward(self, x):
+        n, c, h, w = x.shape
+        dx = (w - 8) // 2
+        dy = (h - 8) // 2
+        crop = x[:, :, dy:dy+8, dx:dx+8]
+        return crop
+
+
+class _Mul(Module):
+    def forward(self, x):
+        return x * x
+
+
+class _MulConst(Module):
+    def forward(self, x):
+        return (2 * x) * (x * 2)
+
+
 class TestUtils:
     def test_compatible_data_format(self):
         assert compatible_data_format(OnnxConstant, OnnxConstant)
@@ -67,390 +351,290 @@ class TestUtils:
 
 
 class TestOnnx:
-    def test_conv(self):
-        net = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 7), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+    def setup_method(self, method):
+        # Seed before the test body builds its net, so weights do not depend on test order
+        seed_everything()
+
+    def teardown_method(self, method):
+        tf.keras.backend.clear_session()
+        gc.collect()
 
-    def test_conv_no_bias(self):
+    def test_conv(self, x_1_3_224_224):
+        net = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 7), torch.nn.ReLU())
+        convert_and_compare_output(net, x_1_3_224_224)
+
+    def test_onnx_cache_swaps_weights(self, x_1_3_16_16, monkeypatch):
+        net1 = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 3), torch.nn.ReLU())
+        net2 = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 3), torch.nn.ReLU())
+        assert not torch.equal(net1[0].weight, net2[0].weight)
+        convert_and_compare_output(net1, x_1_3_16_16)
+        def no_export(*args, **kwargs):
+            raise AssertionError("second conversion missed the ONNX cache")
+        monkeypatch.setattr(torch.onnx, "export", no_export)
+        convert_and_compare_output(net2, x_1_3_16_16)
+
+    def test_conv_no_bias(self, x_1_3_224_224):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 7, bias=False), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_224_224)
 
     def test_conv_padding(self):
         net = torch.nn.Sequential(torch.nn.Conv2d(1, 16, 3, padding=1), torch.nn.ReLU())
-        x = np.random.rand(1, 1, 224, 224).astype(np.float32)
+        x = _rand32(1, 1, 32, 32)
         convert_and_compare_output(net, x)
 
-    def test_prelu(self):
+    def test_prelu(self, x_1_3_224_224):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 7), torch.nn.PReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_224_224)
 
-    def test_prelu_per_channel(self):
+    def test_prelu_per_channel(self, x_1_3_224_224):
         act = torch.nn.PReLU(num_parameters=16)
         with torch.no_grad():
             act.weight[:] = torch.tensor(range(16))
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 7), act)
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x, 5)
+        convert_and_compare_output(net, x_1_3_224_224, 5)
 
-    def test_maxpool(self):
+    def test_maxpool(self, x_1_3_224_224):
         net = torch.nn.Sequential(torch.nn.MaxPool2d(2))
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_224_224)
 
     def test_maxpool_resnet(self):
         net = torch.nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
-        x = np.random.rand(1, 192, 272, 64).astype(np.float32)
+        x = _rand32(1, 32, 34, 32)
         convert_and_compare_output(net, x)
 
-    def test_concat(self):
-        for axis in range(1,4):
-            class Dbl(torch.nn.Module):
-                def forward(self, x):
-                    return torch.cat((x, x), axis)
-            x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-            convert_and_compare_output(Dbl(), x)
+    def test_concat(self, x_1_3_224_224):
+        nets = [_DblCat(axis) for axis in range(1, 4)]
+        convert_and_compare_outputs(nets, x_1_3_224_224)
 
-    def test_conv_transpose(self):
+    def test_conv_transpose(self, x_1_3_112_112):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(3, 16, 5, 2), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 112, 112).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_112_112)
 
-    def test_conv_transpose_padding(self):
+    def test_conv_transpose_padding(self, x_1_3_112_112):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(3, 16, 4, 2, padding=1), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 112, 112).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_112_112)
 
     def test_conv_different_padding(self):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 64, kernel_size=7, stride=1, padding=(3, 4)))
-        x = np.random.rand(1, 3, 384, 544).astype(np.float32)
+        x = _rand32(1, 3, 32, 48)
         convert_and_compare_output(net, x)
 
-    def test_conv_transpose_no_bias(self):
+    def test_conv_transpose_no_bias(self, x_1_3_112_112):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(3, 16, 5, 2, bias=False), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 112, 112).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_112_112)
 
     def test_conv_transpose_grouped_no_bias(self):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(16, 16, 5, 2, groups=2, bias=False), torch.nn.ReLU())
-        x = np.random.rand(1, 16, 112, 112).astype(np.float32)
+        x = _rand32(1, 16, 32, 32)
         convert_and_compare_output(net, x)
 
     def test_conv_transpose_grouped_bias(self):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(16, 16, 5, 2, groups=2), torch.nn.ReLU())
-        x = np.random.rand(1, 16, 112, 112).astype(np.float32)
+        x = _rand32(1, 16, 32, 32)
         convert_and_compare_output(net, x)
 
     def test_conv_transpose_grouped_fully(self):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(16, 16, 5, 2, groups=16), torch.nn.ReLU())
-        x = np.random.rand(1, 16, 112, 112).astype(np.float32)
+        x = _rand32(1, 16, 32, 32)
         convert_and_compare_output(net, x)
 
     def test_conv_transpose_output_padding(self):
         net = torch.nn.Sequential(torch.nn.ConvTranspose2d(16, 16, 3, 2, output_padding=1), torch.nn.ReLU())
-        x = np.random.rand(1, 16, 112, 112).astype(np.float32)
+        x = _rand32(1, 16, 32, 32)
         convert_and_compare_output(net, x)
 
     def test_conv_stride2_padding_strange(self):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3))
-        x = np.random.rand(1, 3, 384, 544).astype(np.float32)
+        x = _rand32(1, 3, 32, 48)
         convert_and_compare_output(net, x)
 
     def test_conv_stride2_padding_simple_odd(self):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 64, kernel_size=3, stride=2, padding=1))
-        x = np.random.rand(1, 3, 223, 223).astype(np.float32)
+        x = _rand32(1, 3, 31, 31)
         kernas_net = convert_and_compare_output(net, x)
         assert [l.__class__.__name__ for l in kernas_net.layers] == ['InputLayer', 'Conv2D']
 
-    def test_conv_stride2_padding_simple_even(self):
+    def test_conv_stride2_padding_simple_even(self, x_1_3_224_224):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 64, kernel_size=3, stride=2, padding=1))
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        kernas_net = convert_and_compare_output(net, x)
+        kernas_net = convert_and_compare_output(net, x_1_3_224_224)
         # assert [l.__class__.__name__ for l in kernas_net.layers] == ['InputLayer', 'Conv2D']
 
-    def test_batchnorm(self):
+    def test_batchnorm(self, x_1_3_224_224):
         bn = torch.nn.BatchNorm2d(3)
         bn.running_mean.uniform_()
         bn.running_var.uniform_()
         net = torch.nn.Sequential(bn, torch.nn.ReLU())
         net.eval()
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_224_224)
 
-    def test_clamp(self):
-        class Clamp(Module):
-            def forward(self, x):
-                return torch.clamp(x, 0.3, 0.7)
-        net = torch.nn.Sequential(torch.nn.ReLU(), Clamp(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x, savable=False)
-
-    def test_relu6(self):
-        class Clamp(Module):
-            def forward(self, x):
-                return torch.clamp(x, 0, 6)
-        net = torch.nn.Sequential(torch.nn.ReLU(), Clamp(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+    def test_clamp(self, x_1_3_224_224):
+        net = torch.nn.Sequential(torch.nn.ReLU(), _Clamp03_07(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_1_3_224_224, savable=False)
 
-    def test_leaky_relu(self):
+    def test_relu6(self, x_1_3_224_224):
+        net = torch.nn.Sequential(torch.nn.ReLU(), _Clamp0_6(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_1_3_224_224)
+
+    def test_leaky_relu(self, x_1_3_224_224):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 3, 3), torch.nn.LeakyReLU(), torch.nn.Conv2d(3, 3, 3))
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_224_224)
 
-    def test_depthwise(self):
+    def test_depthwise(self, x_1_3_224_224):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 3, 7, groups=3), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_224_224)
 
-    def test_depthwise_no_bias(self):
+    def test_depthwise_no_bias(self, x_1_3_224_224):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 3, 7, groups=3, bias=False), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_224_224)
 
-    def test_add(self):
-        class AddTst(Module):
-            def __init__(self):
-                Module.__init__(self)
-                self.conv1 = torch.nn.Conv2d(3, 3, 7)
-                self.conv2 = torch.nn.Conv2d(3, 3, 7)
-            def forward(self, x):
-                return self.conv1(x).relu_() + self.conv2(x).relu_()
-        net = torch.nn.Sequential(AddTst(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+    def test_add(self, x_1_3_224_224):
+        net = torch.nn.Sequential(_AddTst(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_1_3_224_224)
 
-    def test_global_avrage_pooling(self):
+    def test_global_avrage_pooling(self, x_1_3_16_16):
         net = torch.nn.Sequential(GlobalAvgPool(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 16, 16).astype(np.float32)
-        convert_and_compare_output(net, x, image_out=False)
+        convert_and_compare_output(net, x_1_3_16_16, image_out=False)
 
-    def test_dropout(self):
+    def test_dropout(self, x_1_3_16_16):
         net = torch.nn.Sequential(GlobalAvgPool(), torch.nn.Dropout(), torch.nn.ReLU())
         net.eval()
-        x = np.random.rand(1, 3, 16, 16).astype(np.float32)
-        convert_and_compare_output(net, x, image_out=False)
+        convert_and_compare_output(net, x_1_3_16_16, image_out=False)
 
     def test_linear(self):
         net = torch.nn.Sequential(GlobalAvgPool(), torch.nn.Linear(3, 8), torch.nn.ReLU())
         net.eval()
-        x = np.random.rand(5, 3, 16, 16).astype(np.float32)
+        x = _rand32(5, 3, 16, 16)
         convert_and_compare_output(net, x, image_out=False)
 
     def test_linear_no_bias(self):
         net = torch.nn.Sequential(GlobalAvgPool(), torch.nn.Linear(3, 8, bias=False), torch.nn.ReLU())
         net.eval()
-        x = np.random.rand(5, 3, 16, 16).astype(np.float32)
+        x = _rand32(5, 3, 16, 16)
         convert_and_compare_output(net, x, image_out=False)
 
-    def test_mobilenet_v2(self):
+    def test_mobilenet_v2(self, x_1_3_224_224):
         net = models.mobilenet_v2()
         net.eval()
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x, image_out=False)
+        convert_and_compare_output(net, x_1_3_224_224, precition=3, image_out=False)
 
-    def test_avg_pool_pad(self):
-        class PadTst(Module):
-            def forward(self, x):
-                return F.avg_pool2d(x, kernel_size=3, stride=1, padding=1)
-        net = torch.nn.Sequential(PadTst(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+    def test_avg_pool_pad(self, x_1_3_224_224):
+        net = torch.nn.Sequential(_AvgPoolPad(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_1_3_224_224)
 
-    def test_avg_pool_pad_asym(self):
-        class PadTst(Module):
-            def forward(self, x):
-                return F.avg_pool2d(x, kernel_size=(3, 6), stride=(1, 2), padding=(1, 2))
-        net = torch.nn.Sequential(PadTst(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+    def test_avg_pool_pad_asym(self, x_1_3_224_224):
+        net = torch.nn.Sequential(_AvgPoolPadAsym(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_1_3_224_224)
 
-    def test_gloabl_avg_pool(self):
-        class AvgTst(Module):
-            def forward(self, x):
-                return F.adaptive_avg_pool2d(x, (1, 1))
-        net = torch.nn.Sequential(AvgTst(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+    def test_gloabl_avg_pool(self, x_1_3_224_224):
+        net = torch.nn.Sequential(_AdaptiveAvgPool1x1(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_1_3_224_224)
 
     def test_flatten(self):
-        class Tst(Module):
-            def forward(self, x):
-                return torch.flatten(x, 1)
-        net = torch.nn.Sequential(Tst(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 1, 1).astype(np.float32)
+        net = torch.nn.Sequential(_Flatten(), torch.nn.ReLU())
+        x = _rand32(1, 3, 1, 1)
         convert_and_compare_output(net, x, image_out=False)
 
     def test_vector_pad(self):
-        class VectorPad2D(Module):
-            def forward(self, x):
-                tt = [torch.nn.functional.pad(x[:, i:i + 1], [1,1,1,1], 'constant', [1,2,3][i])
-                      for i in range(x.shape[1])]
-                return torch.cat(tt, 1)
-        net = torch.nn.Sequential(VectorPad2D(), torch.nn.ReLU())
-        x = np.random.rand(2, 3, 5, 5).astype(np.float32)
-        convert_and_compare_output(net, x)
+        # op_pad only handles the opset 9 form of Pad, where pads and value are attributes
+        net = torch.nn.Sequential(_VectorPad2D(), torch.nn.ReLU())
+        x = _rand32(2, 3, 5, 5)
+        convert_and_compare_output(net, x, opset_version=9)
 
     def test_vector_pad_addhack(self):
-        class VectorPad2D(Module):
-            def forward(self, x):
-                c = torch.tensor([1,2,3]).reshape(1, 3, 1, 1)
-                return torch.nn.functional.pad(x - c, [1,1,1,1]) + c
-        net = torch.nn.Sequential(VectorPad2D(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 5, 5).astype(np.float32)
-        convert_and_compare_output(net, x)
+        net = torch.nn.Sequential(_VectorPad2DAddHack(), torch.nn.ReLU())
+        x = _rand32(1, 3, 5, 5)
+        convert_and_compare_output(net, x, opset_version=9)
 
     def test_vector_pad_addhack_asym(self):
-        class VectorPad2D(Module):
-            def forward(self, x):
-                c = torch.tensor([1,2,3]).reshape(1, 3, 1, 1)
-                return torch.nn.functional.pad(x - c, [1,0,1,0]) + c
-        net = torch.nn.Sequential(VectorPad2D(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 5, 5).astype(np.float32)
-        convert_and_compare_output(net, x)
+        net = torch.nn.Sequential(_VectorPad2DAddHackAsym(), torch.nn.ReLU())
+        x = _rand32(1, 3, 5, 5)
+        convert_and_compare_output(net, x, opset_version=9)
 
-    def test_sigmoid(self):
+    def test_sigmoid(self, x_1_3_224_224):
         net = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 7), torch.nn.Sigmoid())
-        x = np.random.rand(1, 3, 224, 224).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_1_3_224_224)
 
     def test_upsample_nearest(self):
+        # Upsample was deprecated in opset 10, so this is the only test left covering it
         net = torch.nn.Sequential(torch.nn.UpsamplingNearest2d(scale_factor=2), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 32, 32).astype(np.float32)
-        convert_and_compare_output(net, x)
+        x = _rand32(1, 3, 32, 32)
+        convert_and_compare_output(net, x, opset_version=9)
 
     def test_upsample_nearest_v11(self):
         net = torch.nn.Sequential(torch.nn.UpsamplingNearest2d(scale_factor=2), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 32, 32).astype(np.float32)
-        convert_and_compare_output(net, x, opset_version=11)
+        x = _rand32(1, 3, 32, 32)
+        convert_and_compare_output(net, x)
 
     def test_upsample_bilinear(self):
         net = torch.nn.Sequential(torch.nn.UpsamplingBilinear2d(scale_factor=2), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 32, 32).astype(np.float32)
-        convert_and_compare_output(net, x, opset_version=11)
+        x = _rand32(1, 3, 32, 32)
+        convert_and_compare_output(net, x)
 
     def test_interpolate_nearest(self):
-        class Net(Module):
-            def forward(self, x):
-                return F.interpolate(x, scale_factor=2, mode="nearest")
-        net = torch.nn.Sequential(Net(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 32, 32).astype(np.float32)
+        net = torch.nn.Sequential(_InterpolateNearest(), torch.nn.ReLU())
+        x = _rand32(1, 3, 32, 32)
         convert_and_compare_output(net, x)
 
     def test_interpolate_bilinear(self):
-        class Net(Module):
-            def forward(self, x):
-                return F.interpolate(x, scale_factor=2, mode="bilinear", align_corners=True)
-        net = torch.nn.Sequential(Net(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 32, 32).astype(np.float32)
-        convert_and_compare_output(net, x, opset_version=11)
+        net = torch.nn.Sequential(_InterpolateBilinear(), torch.nn.ReLU())
+        x = _rand32(1, 3, 32, 32)
+        convert_and_compare_output(net, x)
 
     def test_eq_mul(self):
-        class EqProd(Module):
-            def forward(self, x):
-                maxmap = F.max_pool2d(x, 3, 1, 1, 1, False, False)
-                return x * (maxmap == x)
-        net = torch.nn.Sequential(EqProd(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 5, 5).astype(np.float32)
+        net = torch.nn.Sequential(_EqProd(), torch.nn.ReLU())
+        x = _rand32(1, 3, 5, 5)
         convert_and_compare_output(net, x)
 
-    def test_adaptive_avgpool_reshape(self):
-        class Net(Module):
-            def forward(self, x):
-                return F.adaptive_avg_pool2d(x, 1).reshape(x.shape[0], -1)
-        net = torch.nn.Sequential(Net(), torch.nn.ReLU())
-        x = np.random.rand(1, 3, 16, 16).astype(np.float32)
-        convert_and_compare_output(net, x, image_out=False)
-        x = np.random.rand(4, 3, 16, 16).astype(np.float32)
-        convert_and_compare_output(net, x, image_out=False)
+    def test_adaptive_avgpool_reshape(self, x_1_3_16_16, x_4_3_16_16):
+        net = torch.nn.Sequential(_AdaptiveAvgPoolReshape(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_1_3_16_16, image_out=False)
+        convert_and_compare_output(net, x_4_3_16_16, image_out=False)
 
     def test_bmm(self):
-        class Net(Module):
-            def forward(self, x):
-                x = x.reshape(1, 16, 16)
-                return torch.bmm(x, x)
-        net = torch.nn.Sequential(Net(), torch.nn.ReLU())
-        x = np.random.rand(1, 1, 16, 16).astype(np.float32)
+        net = torch.nn.Sequential(_Bmm(), torch.nn.ReLU())
+        x = _rand32(1, 1, 16, 16)
         convert_and_compare_output(net, x, image_out=False)
 
     def test_matmul(self):
-        class Net(Module):
-            def forward(self, x):
-                x = x.reshape(1, 1, 16, 16)
-                return torch.matmul(x, x)
-        net = torch.nn.Sequential(Net(), torch.nn.ReLU())
-        x = np.random.rand(1, 1, 16, 16).astype(np.float32)
+        net = torch.nn.Sequential(_Matmul(), torch.nn.ReLU())
+        x = _rand32(1, 1, 16, 16)
         convert_and_compare_output(net, x, image_out=False)
 
-    def test_unsupported_optimasation(self):
-        class Reshape(Module):
-            def forward(self, x):
-                return x.reshape(4, 4, 16, 16)
-        net = torch.nn.Sequential(GlobalAvgPool(), torch.nn.Linear(3, 4 * 16 * 16), Reshape(),
+    def test_unsupported_optimasation(self, x_4_3_16_16):
+        net = torch.nn.Sequential(GlobalAvgPool(), torch.nn.Linear(3, 4 * 16 * 16), _Reshape4x4x16x16(),
                                   torch.nn.Conv2d(4, 3, 3), torch.nn.ReLU())
         net.eval()
-        x = np.random.rand(4, 3, 16, 16).astype(np.float32)
-        convert_and_compare_output(net, x, missing_optimizations=True)
-
-    def test_sqrt(self):
-        class Sq(Module):
-            def forward(self, x):
-                return torch.sqrt(x)
-        net = torch.nn.Sequential(Sq(), torch.nn.ReLU())
-        x = np.random.rand(4, 3, 16, 16).astype(np.float32)
+        convert_and_compare_output(net, x_4_3_16_16, missing_optimizations=True)
+
+    def test_sqrt(self, x_4_3_16_16):
+        net = torch.nn.Sequential(_Sqrt(), torch.nn.ReLU())
         is_tf1 = tuple(map(int, tf.__version__.split('.'))) < (2, 0, 0)
-        convert_and_compare_output(net, x, savable=(not is_tf1))
-
-    def test_abs(self):
-        class Abs(Module):
-            def forward(self, x):
-                return torch.abs(x)
-        net = torch.nn.Sequential(Abs(), torch.nn.ReLU())
-        x = np.random.rand(4, 3, 16, 16).astype(np.float32)
-        convert_and_compare_output(net, x)
+        convert_and_compare_output(net, x_4_3_16_16, savable=(not is_tf1))
 
-    def test_neg(self):
-        class Neg(Module):
-            def forward(self, x):
-                return -x
-        net = torch.nn.Sequential(Neg(), torch.nn.ReLU())
-        x = np.random.rand(4, 3, 16, 16).astype(np.float32)
-        convert_and_compare_output(net, x)
+    def test_abs(self, x_4_3_16_16):
+        net = torch.nn.Sequential(_Abs(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_4_3_16_16)
+
+    def test_neg(self, x_4_3_16_16):
+        net = torch.nn.Sequential(_Neg(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_4_3_16_16)
+
+    def test_center_crop(self, x_4_3_16_32):
+        net = torch.nn.Sequential(_CenterCrop8x8(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_4_3_16_32)
+
+    def test_mul(self, x_4_3_16_32):
+        net = torch.nn.Sequential(_Mul(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_4_3_16_32)
 
-    def test_center_crop(self):
-        class CenterCrop8x8(Module):
-            def forward(self, x):
-                n, c, h, w = x.shape
-                dx = (w - 8) // 2
-                dy = (h - 8) // 2
-                crop = x[:, :, dy:dy+8, dx:dx+8]
-                return crop
-        net = torch.nn.Sequential(CenterCrop8x8(), torch.nn.ReLU())
-        x = np.random.rand(4, 3, 16, 32).astype(np.float32)
-        convert_and_compare_output(net, x, opset_version=11)
-
-    def test_mul(self):
-        class Mul(Module):
-            def forward(self, x):
-                return x * x
-        net = torch.nn.Sequential(Mul(), torch.nn.ReLU())
-        x = np.random.rand(4, 3, 16, 32).astype(np.float32)
-        convert_and_compare_output(net, x, opset_version=11)
-
-    def test_mul_const(self):
-        class Mul(Module):
-            def forward(self, x):
-                return (2 * x) * (x * 2)
-        net = torch.nn.Sequential(Mul(), torch.nn.ReLU())
-        x = np.random.rand(4, 3, 16, 32).astype(np.float32)
-        convert_and_compare_output(net, x, opset_version=11)
+    def test_mul_const(self, x_4_3_16_32):
+        net = torch.nn.Sequential(_MulConst(), torch.nn.ReLU())
+        convert_and_compare_output(net, x_4_3_16_32)
 
 
 
     # def test_inception_v3(self):
     #     net = models.Inception3(aux_logits=False)
     #     net.eval()
-    #     x = np.random.rand(1, 3, 299, 299).astype(np.float32)
+    #     x = _rand32(1, 3, 299, 299)
     #     convert_and_compare_output(net, x, image_out=False)